@@ -4,7 +4,18 @@ import subprocess
 import threading
 import time
 import requests
+import socket
 import json
+import queue
+import hashlib
+import bisect
+import gzip
+import sqlite3
+import atexit
+import uuid
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+from collections import OrderedDict, deque
 from flask import Flask, Response, request, render_template_string, jsonify, stream_with_context
 import re
 import logging
@@ -32,43 +43,300 @@ STREAM_PORT = int(os.getenv("STREAM_PORT", "5444"))
 CHECK_INTERVAL_SECONDS = 60
 KILL_COUNTDOWN_MINUTES = 6
 CHANNELS = []
-FAVORITES = []
+CHANNEL_INDEX = {}
+CHANNEL_NUMBERS = []
+CHANNEL_NAMES = []
+M3U_VERSION = "0"
+FAVORITES = {}
+FAVORITES_VERSION = "0"
 FAVORITES_FILE = "/app/data/favorites.json"
-STREAM_PROCESS = None
-CURRENT_PID = None
+PRESETS = {}
+HISTORY = deque(maxlen=500)
+
+# State store settings
+STATE_DB = os.getenv("STATE_DB", "/app/data/state.db")
+STATE_FLUSH_SECONDS = 1.0
+STATE_DB_CONN = None
+STATE_PENDING = OrderedDict()
+STATE_LOCK = threading.Lock()
+STATE_DIRTY = threading.Event()
+SESSIONS = {}
+SESSION_LOCK = threading.RLock()
+VIRTUAL_CHANNEL_START = int(os.getenv("VIRTUAL_CHANNEL_START") or "4000")
+COMPILED_MOSAICS = OrderedDict()
+COMPILED_MOSAICS_MAX = 64
+COMPILED_LOCK = threading.Lock()
+
+# Cluster settings: standalone encodes locally, a controller places sessions on workers
+ROLE = os.getenv("ROLE") or "standalone"
+CONTROLLER_URL = os.getenv("CONTROLLER_URL", "").rstrip('/')
+WORKER_URL = (os.getenv("WORKER_URL") or f"http://{socket.gethostname()}:{WEB_PAGE_PORT}").rstrip('/')
+WORKER_ID = os.getenv("WORKER_ID") or WORKER_URL
+WORKER_CAPACITY = int(os.getenv("WORKER_CAPACITY") or "2")
+WORKER_HEARTBEAT_SECONDS = 5
+WORKER_TIMEOUT_SECONDS = 15
+WORKER_RETRIES = 3
+WORKERS = {}
+PLACEMENTS = {}
+WORKER_LOCK = threading.Lock()
+if ROLE not in ('standalone', 'controller', 'worker'):
+    logging.error("*** Unknown ROLE %s, running standalone", ROLE)
+    ROLE = 'standalone'
 
 # Mosaic settings
 TARGET_WIDTH = 1280
 TARGET_HEIGHT = 720
 TARGET_FPS = float(os.getenv("OUTPUT_FPS", "29.97"))
 BITRATE = "5120k"
+# Comma separated name=WIDTHxHEIGHT@BITRATE list, the first entry is the default
+RENDITIONS_SPEC = os.getenv("RENDITIONS", f"720p={TARGET_WIDTH}x{TARGET_HEIGHT}@{BITRATE}")
+LAYOUTS = ('grid',)
+AUDIO_POLICIES = ('all', '1', '2', '3', '4')
+CHUNK_SIZE = 1024 * 16
+SUBSCRIBER_QUEUE_CHUNKS = 256
 
-def load_favorites():
-    """Load favorite channels from JSON file."""
-    global FAVORITES
+# Thumbnail settings
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_CACHE_BYTES = int(os.getenv("THUMBNAIL_CACHE_MB", "16")) * 1024 * 1024
+THUMBNAIL_INTERVAL_SECONDS = int(os.getenv("THUMBNAIL_INTERVAL_SECONDS", "15"))
+THUMBNAIL_MAX_AGE_SECONDS = int(os.getenv("THUMBNAIL_MAX_AGE_SECONDS", "1800"))
+THUMBNAIL_TIMEOUT_SECONDS = 20
+THUMBNAIL_RETRY_SECONDS = 60
+TUNER_COUNT = int(os.getenv("TUNER_COUNT") or "4")
+THUMBNAILS = OrderedDict()
+THUMBNAIL_BYTES = 0
+THUMBNAIL_REQUESTS = OrderedDict()
+THUMBNAIL_FAILED = {}
+THUMBNAIL_GRABS = 0
+THUMBNAIL_SWEEP_DONE = False
+THUMBNAIL_LOCK = threading.Lock()
+
+# Channel API settings
+CHANNEL_PAGE_SIZE = 100
+CHANNEL_PAGE_MAX = 500
+CHANNEL_FIELDS = ('number', 'name', 'favorite')
+GZIP_MIN_BYTES = 1024
+
+def parse_renditions(spec):
+    """Parse the RENDITIONS spec into a list of rendition dicts."""
+    renditions = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        match = re.fullmatch(r'([\w-]+)=(\d+)x(\d+)@(\d+[kKmM]?)', entry)
+        if not match:
+            logging.error("*** Ignoring invalid rendition: %s", entry)
+            continue
+        renditions.append({
+            'name': match.group(1),
+            'width': int(match.group(2)) // 2 * 2,
+            'height': int(match.group(3)) // 2 * 2,
+            'bitrate': match.group(4)
+        })
+    if not renditions:
+        renditions.append({'name': '720p', 'width': TARGET_WIDTH, 'height': TARGET_HEIGHT, 'bitrate': BITRATE})
+    return renditions
+
+RENDITIONS = parse_renditions(RENDITIONS_SPEC)
+logging.info("*** Renditions: %s", ', '.join(f"{r['name']} {r['width']}x{r['height']}@{r['bitrate']}" for r in RENDITIONS))
+
+def open_state_store():
+    """Open the SQLite state store in WAL mode, creating it if needed."""
+    global STATE_DB_CONN
     try:
-        with open(FAVORITES_FILE, 'r') as f:
-            FAVORITES = json.load(f)
-        logging.info("*** Favorites loaded: %d from %s", len(FAVORITES), FAVORITES_FILE)
+        conn = sqlite3.connect(STATE_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        conn.commit()
+        STATE_DB_CONN = conn
+        logging.info("*** State store opened: %s", STATE_DB)
     except Exception as e:
-        logging.error("*** Error loading favorites: %s", str(e))
-        FAVORITES = []
+        logging.error("*** Error opening state store: %s", str(e))
 
-def save_favorites():
-    """Save favorite channels to JSON file."""
+def state_load(namespace, limit=None):
+    """Return (key, value) pairs of a namespace in insertion order."""
+    if not STATE_DB_CONN:
+        return []
+    query = "SELECT key, value FROM state WHERE namespace = ? ORDER BY rowid"
+    params = (namespace,)
+    if limit:
+        query = ("SELECT key, value FROM (SELECT rowid, key, value FROM state WHERE namespace = ? "
+                 "ORDER BY rowid DESC LIMIT ?) ORDER BY rowid")
+        params = (namespace, limit)
+    with STATE_LOCK:
+        rows = STATE_DB_CONN.execute(query, params).fetchall()
+    return [(key, json.loads(value)) for key, value in rows]
+
+def state_put(namespace, key, value):
+    """Queue a write; repeated writes to one key before the next flush collapse into one."""
+    if not STATE_DB_CONN:
+        # Nothing could ever flush it, keep the change in memory only
+        return
+    with STATE_LOCK:
+        STATE_PENDING.pop((namespace, key), None)
+        STATE_PENDING[(namespace, key)] = value
+    STATE_DIRTY.set()
+
+def state_delete(namespace, key):
+    """Queue a delete."""
+    state_put(namespace, key, None)
+
+def flush_state():
+    """Write every queued change in a single transaction."""
+    with STATE_LOCK:
+        if not STATE_DB_CONN or not STATE_PENDING:
+            return
+        pending = list(STATE_PENDING.items())
+        STATE_PENDING.clear()
+        now = time.time()
+        try:
+            with STATE_DB_CONN:
+                for (namespace, key), value in pending:
+                    if value is None:
+                        STATE_DB_CONN.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+                    else:
+                        STATE_DB_CONN.execute(
+                            "INSERT INTO state (namespace, key, value, updated) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                            (namespace, key, json.dumps(value, separators=(',', ':')), now)
+                        )
+                STATE_DB_CONN.execute(
+                    "DELETE FROM state WHERE namespace = 'history' AND rowid NOT IN "
+                    "(SELECT rowid FROM state WHERE namespace = 'history' ORDER BY rowid DESC LIMIT ?)",
+                    (HISTORY.maxlen,)
+                )
+            logging.info("*** State flushed: %d changes", len(pending))
+        except Exception as e:
+            logging.error("*** Error flushing state: %s", str(e))
+            # Keep the failed batch unless a newer write superseded it
+            for item, value in pending:
+                STATE_PENDING.setdefault(item, value)
+
+def state_writer():
+    """Background loop flushing queued writes once they settle."""
+    while True:
+        STATE_DIRTY.wait()
+        time.sleep(STATE_FLUSH_SECONDS)
+        STATE_DIRTY.clear()
+        flush_state()
+
+def favorites_version():
+    """Hash of the favorites content, stable across restarts."""
+    return hashlib.sha1(json.dumps(list(FAVORITES.values()), sort_keys=True).encode()).hexdigest()[:12]
+
+def read_favorites_file():
+    """Read favorites.json into a dict keyed by channel number."""
+    if not os.path.exists(FAVORITES_FILE):
+        return {}
     try:
-        with open(FAVORITES_FILE, 'w') as f:
-            json.dump(FAVORITES, f, indent=2)
-        os.chmod(FAVORITES_FILE, 0o666)
-        logging.info("*** Favorites saved: %d to %s", len(FAVORITES), FAVORITES_FILE)
+        with open(FAVORITES_FILE, 'r') as f:
+            return {fav['number']: fav for fav in json.load(f)}
     except Exception as e:
-        logging.error("*** Error saving favorites: %s", str(e))
+        logging.error("*** Error reading favorites: %s", str(e))
+        return {}
+
+def load_favorites():
+    """Load favorite channels from the state store, importing favorites.json once."""
+    global FAVORITES, FAVORITES_VERSION
+    if not STATE_DB_CONN:
+        # Without a store fall back to favorites.json, changes last until restart
+        FAVORITES = read_favorites_file()
+        logging.info("*** Favorites read from %s, state store unavailable", FAVORITES_FILE)
+    else:
+        FAVORITES = {key: fav for key, fav in state_load('favorites')}
+        if not dict(state_load('meta')).get('favorites_imported'):
+            # Import once; an emptied favorites list must stay empty after restarts
+            if not FAVORITES:
+                FAVORITES = read_favorites_file()
+                for number, fav in FAVORITES.items():
+                    state_put('favorites', number, fav)
+                if FAVORITES:
+                    logging.info("*** Favorites imported from %s", FAVORITES_FILE)
+            state_put('meta', 'favorites_imported', True)
+    FAVORITES_VERSION = favorites_version()
+    logging.info("*** Favorites loaded: %d", len(FAVORITES))
+
+def next_virtual_channel():
+    """Lowest unused virtual channel number for a preset."""
+    used = {preset.get('number') for preset in PRESETS.values()}
+    number = VIRTUAL_CHANNEL_START
+    while str(number) in used:
+        number += 1
+    return str(number)
 
+def load_presets():
+    """Load saved mosaic presets and recent session history from the state store."""
+    PRESETS.update(state_load('presets'))
+    for preset in PRESETS.values():
+        if not preset.get('number'):
+            preset['number'] = next_virtual_channel()
+            state_put('presets', preset['id'], preset)
+    HISTORY.extend(entry for _, entry in state_load('history', HISTORY.maxlen))
+    logging.info("*** Presets loaded: %d", len(PRESETS))
+
+def shutdown(signum, frame):
+    """Exit through atexit so queued state is flushed."""
+    sys.exit(0)
+
+open_state_store()
 load_favorites()
+load_presets()
+atexit.register(flush_state)
+signal.signal(signal.SIGTERM, shutdown)
+threading.Thread(target=state_writer, daemon=True).start()
+
+def build_channel_index(channels):
+    """Index channels by number and lowercased name for lookups and search."""
+    global CHANNELS, CHANNEL_INDEX, CHANNEL_NUMBERS, CHANNEL_NAMES, M3U_VERSION
+    CHANNEL_INDEX = {channel['number']: (position, channel) for position, channel in enumerate(channels)}
+    CHANNEL_NUMBERS = sorted(CHANNEL_INDEX)
+    CHANNEL_NAMES = [(channel['name'].lower(), channel['number']) for channel in channels]
+    M3U_VERSION = hashlib.sha1(json.dumps(channels, sort_keys=True).encode()).hexdigest()[:12]
+    CHANNELS = channels
+
+def name_match_score(name, query):
+    """Rank how well a lowercased channel name matches a query, lower is better."""
+    if name == query:
+        return 0
+    if name.startswith(query):
+        return 1
+    if any(word.startswith(query) for word in name.split()):
+        return 2
+    if query in name:
+        return 3
+    if len(query) >= 3:
+        # Fuzzy: every query character appears in order
+        chars = iter(name)
+        if all(c in chars for c in query):
+            return 4
+    return None
+
+def search_channels(query):
+    """Return channels matching a number prefix or a fuzzy name, best matches first."""
+    query = query.strip().lower()
+    if not query:
+        return CHANNELS
+    scores = {}
+    start = bisect.bisect_left(CHANNEL_NUMBERS, query)
+    for number in CHANNEL_NUMBERS[start:]:
+        if not number.startswith(query):
+            break
+        scores[number] = 0 if number == query else 1
+    for name, number in CHANNEL_NAMES:
+        score = name_match_score(name, query)
+        if score is not None and score < scores.get(number, score + 1):
+            scores[number] = score
+    ranked = sorted(scores, key=lambda number: (scores[number], CHANNEL_INDEX[number][0]))
+    return [CHANNEL_INDEX[number][1] for number in ranked]
 
 def scrape_m3u():
     """Scrape channel list from Channels DVR M3U."""
-    global CHANNELS
     try:
         m3u_url = f"http://{CDVR_HOST}:{CDVR_PORT}/devices/ANY/channels.m3u"
         response = requests.get(m3u_url, timeout=5)
@@ -95,7 +363,7 @@ def scrape_m3u():
                             'name': current_channel['name']
                         })
                     current_channel = {}
-            CHANNELS = channels
+            build_channel_index(channels)
             logging.info("*** Channels loaded: %d from M3U", len(CHANNELS))
         else:
             logging.error("*** Failed to fetch M3U: Status %d", response.status_code)
@@ -264,6 +532,36 @@ HTML_TEMPLATE = """
         #favorites li:hover {
             background: #444;
         }
+        #presets {
+            margin-top: 1.5em;
+            text-align: center;
+        }
+        #presets h2 {
+            font-size: 1.3em;
+            margin: 0.5em 0;
+        }
+        #presets ul {
+            list-style: none;
+            padding: 0;
+        }
+        #presets li {
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            font-size: 0.95em;
+            padding: 0.6em;
+            background: #333;
+            margin: 0.3em;
+            border-radius: 4px;
+            cursor: pointer;
+        }
+        #presets li:hover {
+            background: #444;
+        }
+        #presets .delete {
+            padding: 0 0.5em;
+            color: #dc3545;
+        }
         #channels-page {
             display: none;
             padding: 4.5em 1em 1em;
@@ -278,6 +576,13 @@ HTML_TEMPLATE = """
             list-style: none;
             padding: 0;
         }
+        #channel-search {
+            width: 100%;
+            font-size: 1.1em;
+            padding: 0.4em;
+            box-sizing: border-box;
+            border-radius: 4px;
+        }
         #channels-page li {
             display: flex;
             justify-content: space-between;
@@ -288,6 +593,17 @@ HTML_TEMPLATE = """
             border-radius: 4px;
             font-size: 0.95em;
         }
+        #channels-page li .thumb {
+            width: 80px;
+            height: 45px;
+            object-fit: cover;
+            margin-right: 0.6em;
+            border-radius: 2px;
+            background: #222;
+        }
+        #channels-page li .label {
+            flex: 1;
+        }
         .heart {
             cursor: pointer;
             font-size: 1.2em;
@@ -405,7 +721,12 @@ HTML_TEMPLATE = """
                 <div><input name="ch4" type="text" placeholder="Ch4" inputmode="decimal"></div>
             </div>
             <input type="submit" value="Start Stream">
+            <input type="submit" id="save-preset" value="Save Preset">
         </form>
+        <div id="presets">
+            <h2>Presets</h2>
+            <ul id="presets-list"></ul>
+        </div>
         <div id="favorites">
             <h2>Favorites</h2>
             <ul id="favorites-list"></ul>
@@ -413,7 +734,9 @@ HTML_TEMPLATE = """
     </div>
     <div id="channels-page">
         <h2>Available Channels</h2>
+        <input id="channel-search" type="search" placeholder="Search by number or name">
         <ul id="channels-list"></ul>
+        <div id="channels-sentinel"></div>
         <div class="button-group">
             <button class="save" onclick="saveFavorites()">Save</button>
             <button class="back" onclick="goHome()">Back</button>
@@ -452,28 +775,79 @@ HTML_TEMPLATE = """
                 });
         }
 
+        const channelsList = document.getElementById('channels-list');
+        const channelSearch = document.getElementById('channel-search');
+        const CHANNEL_PAGE_SIZE = 100;
+        let channelQuery = '';
+        let channelsNextOffset = 0;
+        let channelsGeneration = 0;
+        let channelsLoading = false;
+        let searchTimer = null;
+
         function showChannels() {
-            fetch('/channels')
+            mainContainer.style.display = 'none';
+            channelsPage.style.display = 'block';
+            menu.classList.remove('open');
+            resetChannels();
+        }
+
+        function resetChannels() {
+            channelsGeneration++;
+            channelsLoading = false;
+            channelsNextOffset = 0;
+            channelsList.innerHTML = '';
+            loadChannelsPage();
+        }
+
+        function loadChannelsPage() {
+            if (channelsLoading || channelsNextOffset === null) return;
+            channelsLoading = true;
+            const generation = channelsGeneration;
+            const params = new URLSearchParams({
+                offset: channelsNextOffset,
+                limit: CHANNEL_PAGE_SIZE,
+                fields: 'number,name,favorite',
+                favorites: 0
+            });
+            if (channelQuery) params.set('q', channelQuery);
+            fetch('/channels?' + params)
                 .then(response => response.json())
                 .then(data => {
-                    const channelsList = document.getElementById('channels-list');
-                    channelsList.innerHTML = '';
+                    if (generation !== channelsGeneration) return;
+                    const fragment = document.createDocumentFragment();
                     data.channels.forEach(channel => {
                         const li = document.createElement('li');
-                        const isFavorited = data.favorites.some(fav => fav.number === channel.number);
                         li.innerHTML = `
-                            ${channel.name} (${channel.number})
-                            <span class="heart ${isFavorited ? 'favorited' : ''}" data-number="${channel.number}" data-name="${channel.name}">${isFavorited ? '♥' : '♡'}</span>
+                            <img class="thumb" src="/thumbnail/${channel.number}" loading="lazy" alt="" onerror="this.style.visibility='hidden'">
+                            <span class="label">${channel.name} (${channel.number})</span>
+                            <span class="heart ${channel.favorite ? 'favorited' : ''}" data-number="${channel.number}" data-name="${channel.name}">${channel.favorite ? '♥' : '♡'}</span>
                         `;
-                        channelsList.appendChild(li);
+                        attachHeartListener(li.querySelector('.heart'));
+                        fragment.appendChild(li);
                     });
-                    mainContainer.style.display = 'none';
-                    channelsPage.style.display = 'block';
-                    menu.classList.remove('open');
-                    attachHeartListeners();
+                    channelsList.appendChild(fragment);
+                    channelsNextOffset = data.next_offset;
+                    channelsLoading = false;
+                })
+                .catch(() => {
+                    if (generation === channelsGeneration) channelsLoading = false;
                 });
         }
 
+        channelSearch.addEventListener('input', () => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => {
+                channelQuery = channelSearch.value.trim();
+                resetChannels();
+            }, 250);
+        });
+
+        new IntersectionObserver(entries => {
+            if (entries[0].isIntersecting && channelsPage.style.display === 'block') {
+                loadChannelsPage();
+            }
+        }).observe(document.getElementById('channels-sentinel'));
+
         function closeStream() {
             fetch('/stop', { method: 'POST' })
                 .then(response => response.json())
@@ -505,22 +879,20 @@ HTML_TEMPLATE = """
             notification.style.display = 'none';
         }
 
-        function attachHeartListeners() {
-            document.querySelectorAll('.heart').forEach(heart => {
-                heart.addEventListener('click', () => {
-                    const number = heart.dataset.number;
-                    const name = heart.dataset.name;
-                    fetch('/toggle_favorite', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ number, name })
-                    })
-                    .then(response => response.json())
-                    .then(data => {
-                        heart.classList.toggle('favorited');
-                        heart.textContent = heart.classList.contains('favorited') ? '♥' : '♡';
-                        updateFavoritesList(data.favorites);
-                    });
+        function attachHeartListener(heart) {
+            heart.addEventListener('click', () => {
+                const number = heart.dataset.number;
+                const name = heart.dataset.name;
+                fetch('/toggle_favorite', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ number, name })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    heart.classList.toggle('favorited');
+                    heart.textContent = heart.classList.contains('favorited') ? '♥' : '♡';
+                    updateFavoritesList(data.favorites);
                 });
             });
         }
@@ -545,34 +917,80 @@ HTML_TEMPLATE = """
             });
         }
 
-        fetch('/channels')
+        fetch('/channels?limit=0')
             .then(response => response.json())
             .then(data => updateFavoritesList(data.favorites));
 
-        streamForm.addEventListener('submit', e => {
-            e.preventDefault();
+        function showNotification(message) {
+            notificationText.textContent = message;
+            notification.style.display = 'block';
+            setTimeout(() => {
+                notification.style.display = 'none';
+            }, 5000);
+        }
+
+        function formChannels() {
             const formData = new FormData(streamForm);
             const channels = [];
             formData.forEach((value, key) => {
                 if (value) channels.push(value);
             });
-            const url = '/combine?' + channels.map(ch => `ch=${ch}`).join('&');
+            return channels;
+        }
+
+        function startStream(url) {
             fetch(url)
                 .then(response => {
-                    if (response.ok) {
-                        notificationText.textContent = 'Stream started';
-                        notification.style.display = 'block';
-                        setTimeout(() => {
-                            notification.style.display = 'none';
-                        }, 5000);
-                    } else {
-                        notificationText.textContent = 'Failed to start stream';
-                        notification.style.display = 'block';
-                        setTimeout(() => {
-                            notification.style.display = 'none';
-                        }, 5000);
-                    }
+                    showNotification(response.ok ? 'Stream started' : 'Failed to start stream');
+                });
+        }
+
+        function loadPresets() {
+            fetch('/presets')
+                .then(response => response.json())
+                .then(data => {
+                    const presetsList = document.getElementById('presets-list');
+                    presetsList.innerHTML = '';
+                    data.presets.forEach(preset => {
+                        const li = document.createElement('li');
+                        const label = document.createElement('span');
+                        label.textContent = `${preset.number} - ${preset.name} (${preset.channels.join(", ")})`;
+                        const del = document.createElement('span');
+                        del.className = 'delete';
+                        del.textContent = '✕';
+                        del.addEventListener('click', e => {
+                            e.stopPropagation();
+                            fetch(`/presets/${preset.id}`, { method: 'DELETE' }).then(loadPresets);
+                        });
+                        li.append(label, del);
+                        li.addEventListener('click', () => startStream(`/preset/${preset.id}`));
+                        presetsList.appendChild(li);
+                    });
                 });
+        }
+
+        loadPresets();
+
+        streamForm.addEventListener('submit', e => {
+            e.preventDefault();
+            const channels = formChannels();
+            if (e.submitter && e.submitter.id === 'save-preset') {
+                if (!channels.length) return;
+                const name = prompt('Preset name', channels.join(' / '));
+                if (name === null) return;
+                fetch('/presets', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ name, channels })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    showNotification(data.preset ? 'Preset saved' : data.message);
+                    loadPresets();
+                });
+                return;
+            }
+            startStream('/combine?' + channels.map(ch => `ch=${ch}`).join('&'));
         });
     </script>
 </body>
@@ -595,33 +1013,54 @@ def start_stream():
     query = "&".join(f"ch={ch}" for ch in channels)
     return jsonify({"message": f"Stream started, access at /combine?{query}"})
 
-@app.route("/combine")
-def combine_streams():
-    global STREAM_PROCESS, CURRENT_PID
-    channels = request.args.getlist('ch')[:4]
-    if not channels:
-        return "No channels provided", 400
+def build_filter_complex(num_inputs, renditions, layout='grid'):
+    """Build the filter graph: scale each input, xstack once, then split per rendition."""
+    mosaic_width = max(r['width'] for r in renditions)
+    mosaic_height = max(r['height'] for r in renditions)
 
-    # Terminate existing stream
-    if CURRENT_PID and STREAM_PROCESS:
-        try:
-            logging.info("*** Terminating FFmpeg process PID %d", CURRENT_PID)
-            STREAM_PROCESS.terminate()
-            STREAM_PROCESS.wait(timeout=5)
-            logging.info("*** FFmpeg process PID %d terminated", CURRENT_PID)
-        except ProcessLookupError:
-            logging.info("*** Previous FFmpeg process already terminated")
-        except subprocess.TimeoutExpired:
-            logging.warning("*** FFmpeg process PID %d did not terminate gracefully, forcing kill", CURRENT_PID)
-            STREAM_PROCESS.kill()
-            STREAM_PROCESS.wait(timeout=2)
-        except Exception as e:
-            logging.error("*** Error terminating FFmpeg process: %s", str(e))
-        CURRENT_PID = None
-        STREAM_PROCESS = None
+    # Build scaling filters, a single channel fills the whole canvas
+    cells = 1 if num_inputs == 1 else 2
+    filter_parts = [
+        f'[{i}:v]fps={TARGET_FPS},scale={mosaic_width//cells}:{mosaic_height//cells},setsar=1[v{i}]' for i in range(num_inputs)
+    ]
+
+    # Build xstack layout
+    layout_maps = {
+        'grid': {
+            1: "[v0]null[v]",
+            2: "[v0][v1]xstack=inputs=2:layout=0_0|w0_0[v]",
+            3: "[v0][v1][v2]xstack=inputs=3:layout=0_0|w0_0|0_h0[v]",
+            4: "[v0][v1][v2][v3]xstack=inputs=4:layout=0_0|w0_0|0_h0|w0_h0[v]"
+        }
+    }
+    filter_parts.append(layout_maps[layout][num_inputs])
+
+    # Split the composite once and fit each branch to its rendition, the xstack
+    # output is only as large as the tiles used so partial grids keep their aspect
+    filter_parts.append('[v]split=%d%s' % (len(renditions), ''.join(f'[s{k}]' for k in range(len(renditions)))))
+    for k, rendition in enumerate(renditions):
+        width, height = rendition['width'], rendition['height']
+        branch = [
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease:force_divisible_by=2",
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+            'setsar=1'
+        ]
+        if VIDEO_CODEC == 'h264_qsv':
+            # h264_qsv uploads nv12 system frames itself
+            branch.append('format=nv12')
+        filter_parts.append(f'[s{k}]' + ','.join(branch) + f'[r{k}]')
+
+    return ';'.join(filter_parts)
+
+def build_ffmpeg_cmd(channels, renditions, layout='grid', audio='all'):
+    """Build one ffmpeg command writing each rendition as MPEG-TS to its own pipe.
 
+    The audio policy is 'all' to keep every channel's audio as its own track,
+    or a tile number to keep only that channel's audio. Output pipes are left
+    as placeholders; returns the command and the positions to fill with
+    bind_outputs().
+    """
     urls = [f"http://{CDVR_HOST}:{CDVR_PORT}/devices/ANY/channels/{ch}/stream.mpg" for ch in channels]
-    num_inputs = len(urls)
 
     ffmpeg_cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
 
@@ -629,99 +1068,614 @@ def combine_streams():
     for url in urls:
         ffmpeg_cmd += ['-i', url]
 
-    # Build scaling filters
-    filter_parts = [
-        f'[{i}:v]fps={TARGET_FPS},scale={TARGET_WIDTH//2}:{TARGET_HEIGHT//2},setsar=1[v{i}]' for i in range(num_inputs)
-    ]
-
-    # Build xstack layout
-    layout_map = {
-        1: "[v0]xstack=inputs=1:layout=0_0[v]",
-        2: "[v0][v1]xstack=inputs=2:layout=0_0|w0_0[v]",
-        3: "[v0][v1][v2]xstack=inputs=3:layout=0_0|w0_0|0_h0[v]",
-        4: "[v0][v1][v2][v3]xstack=inputs=4:layout=0_0|w0_0|0_h0|w0_h0[v]"
-    }
-    filter_parts.append(layout_map[num_inputs])
+    ffmpeg_cmd += ['-filter_complex', build_filter_complex(len(urls), renditions, layout)]
+    audio_inputs = list(enumerate(channels)) if audio == 'all' else [(int(audio) - 1, channels[int(audio) - 1])]
 
-    filter_complex = ';'.join(filter_parts)
+    outputs = []
+    for k, rendition in enumerate(renditions):
+        ffmpeg_cmd += ['-map', f'[r{k}]']
 
-    ffmpeg_cmd += ['-filter_complex', filter_complex, '-map', '[v]']
+        # Map audio tracks individually
+        for track, (i, ch) in enumerate(audio_inputs):
+            ffmpeg_cmd += [
+                '-map', f'{i}:a',
+                '-metadata:s:a:%d' % track, f'title=Ch {ch} Audio'
+            ]
 
-    # Map all audio tracks individually
-    for i, ch in enumerate(channels):
+        # Encoding settings
         ffmpeg_cmd += [
-            '-map', f'{i}:a',
-            '-metadata:s:a:%d' % i, f'title=Ch {ch} Audio'
+            '-c:v', VIDEO_CODEC,
+            '-b:v', rendition['bitrate'],
+            '-preset', 'fast' if VIDEO_CODEC == 'libx264' else 'medium',
+            '-c:a', 'aac',
+            '-b:a', '128k',
+            '-f', 'mpegts',
+            'pipe:'
         ]
+        outputs.append(len(ffmpeg_cmd) - 1)
 
-    # Encoding settings
-    encoding_params = [
-        '-c:v', VIDEO_CODEC,
-        '-b:v', BITRATE,
-        '-preset', 'fast' if VIDEO_CODEC == 'libx264' else 'medium',
-        '-c:a', 'aac',
-        '-b:a', '128k',
-        '-f', 'mpegts',
-        'pipe:1'
-    ]
-    if VIDEO_CODEC == 'h264_qsv':
-        encoding_params += ['-vf', 'hwupload=extra_hw_frames=64,format=qsv']
-    ffmpeg_cmd += encoding_params
+    return ffmpeg_cmd, outputs
 
-    def generate():
-        global STREAM_PROCESS, CURRENT_PID
-        STREAM_PROCESS = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        CURRENT_PID = STREAM_PROCESS.pid
-        logging.info("*** FFmpeg started with PID %d for channels: %s", CURRENT_PID, ', '.join(channels))
+def compile_mosaic(channels, layout='grid', audio='all'):
+    """Return the cached ffmpeg command for a mosaic, building it on first use."""
+    key = (tuple(channels), layout, audio)
+    with COMPILED_LOCK:
+        compiled = COMPILED_MOSAICS.get(key)
+        if compiled:
+            COMPILED_MOSAICS.move_to_end(key)
+            return compiled
+    unknown = [ch for ch in channels if CHANNEL_INDEX and ch not in CHANNEL_INDEX]
+    if unknown:
+        logging.warning("*** Channels not in the M3U: %s", ', '.join(unknown))
+    ffmpeg_cmd, outputs = build_ffmpeg_cmd(channels, RENDITIONS, layout, audio)
+    compiled = {'cmd': tuple(ffmpeg_cmd), 'outputs': tuple(outputs)}
+    with COMPILED_LOCK:
+        COMPILED_MOSAICS[key] = compiled
+        while len(COMPILED_MOSAICS) > COMPILED_MOSAICS_MAX:
+            COMPILED_MOSAICS.popitem(last=False)
+    return compiled
+
+def bind_outputs(compiled, output_fds):
+    """Fill a compiled command's output placeholders with pipe file descriptors."""
+    ffmpeg_cmd = list(compiled['cmd'])
+    for position, fd in zip(compiled['outputs'], output_fds):
+        ffmpeg_cmd[position] = f'pipe:{fd}'
+    return ffmpeg_cmd
+
+def compile_presets():
+    """Build the ffmpeg command of every saved preset ahead of its first tune."""
+    for preset in PRESETS.values():
+        compile_mosaic(preset['channels'], preset['layout'], preset['audio'])
+    logging.info("*** Precompiled %d preset pipelines", len(PRESETS))
+
+compile_presets()
+
+class MosaicSession:
+    """One ffmpeg process for a channel set, fanned out to the subscribers of each rendition."""
+
+    def __init__(self, channels, renditions, layout='grid', audio='all', preset=None, key=None):
+        self.key = key
+        self.channels = channels
+        self.renditions = renditions
+        self.layout = layout
+        self.audio = audio
+        self.preset = preset
+        self.process = None
+        self.started = None
+        self.stopped = None
+        self.subscribers = {r['name']: [] for r in renditions}
+        self.lock = threading.Lock()
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def matches(self, channels, layout, audio):
+        return self.channels == channels and self.layout == layout and self.audio == audio
+
+    def history_entry(self):
+        return {
+            'channels': self.channels,
+            'layout': self.layout,
+            'audio': self.audio,
+            'preset': self.preset,
+            'renditions': [r['name'] for r in self.renditions],
+            'started': self.started,
+            'stopped': self.stopped
+        }
+
+    def _record_history(self):
+        state_put('history', f"{int(self.started * 1000)}-{self.pid}", self.history_entry())
+
+    def start(self):
+        pipes = [os.pipe() for _ in self.renditions]
+        write_fds = [w for _, w in pipes]
+        ffmpeg_cmd = bind_outputs(compile_mosaic(self.channels, self.layout, self.audio), write_fds)
+        try:
+            self.process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, pass_fds=write_fds)
+        finally:
+            for fd in write_fds:
+                os.close(fd)
+        logging.info("*** FFmpeg started with PID %d for channels: %s (%s)", self.pid, ', '.join(self.channels),
+                     ', '.join(r['name'] for r in self.renditions))
+        self.started = time.time()
+        self._record_history()
+        for rendition, (read_fd, _) in zip(self.renditions, pipes):
+            threading.Thread(target=self._pump, args=(rendition['name'], read_fd), daemon=True).start()
+
+    def _pump(self, name, fd):
+        """Copy one rendition's output to every subscriber queue."""
         try:
             while True:
-                chunk = STREAM_PROCESS.stdout.read(1024 * 16)
+                chunk = os.read(fd, CHUNK_SIZE)
                 if not chunk:
                     break
-                yield chunk
+                with self.lock:
+                    subscribers = list(self.subscribers[name])
+                for q in subscribers:
+                    try:
+                        q.put_nowait(chunk)
+                    except queue.Full:
+                        logging.warning("*** Dropping slow client on rendition %s", name)
+                        self._end(q)
+                        self.unsubscribe(name, q)
         except Exception as e:
             logging.error("*** Error streaming: %s", str(e))
         finally:
-            if STREAM_PROCESS:
-                STREAM_PROCESS.terminate()
-                try:
-                    STREAM_PROCESS.wait(timeout=5)
-                    logging.info("*** FFmpeg process PID %d terminated", CURRENT_PID)
-                except subprocess.TimeoutExpired:
-                    STREAM_PROCESS.kill()
-                    logging.warning("*** FFmpeg process PID %d killed", CURRENT_PID)
-                CURRENT_PID = None
-                STREAM_PROCESS = None
+            os.close(fd)
+            with self.lock:
+                subscribers = list(self.subscribers[name])
+            for q in subscribers:
+                self._end(q)
+            self.stop()
 
-    # Start monitoring for Channels DVR activity
-    if CDVR_CHNLNUM:
-        threading.Thread(target=watch_for_quit, daemon=True).start()
+    @staticmethod
+    def _end(q):
+        """Replace whatever a subscriber has buffered with the end-of-stream marker."""
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                break
+        q.put_nowait(None)
 
-    return Response(stream_with_context(generate()), mimetype='video/MP2T')
+    def subscribe(self, name):
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_CHUNKS)
+        with self.lock:
+            self.subscribers[name].append(q)
+        return q
 
-@app.route("/stop", methods=["POST"])
-def stop_stream():
-    global STREAM_PROCESS, CURRENT_PID
-    if CURRENT_PID and STREAM_PROCESS:
+    def unsubscribe(self, name, q):
+        with self.lock:
+            if q in self.subscribers[name]:
+                self.subscribers[name].remove(q)
+            remaining = sum(len(s) for s in self.subscribers.values())
+        if remaining == 0:
+            self.stop()
+
+    def stop(self):
+        process = self.process
+        if not process:
+            return False
+        with self.lock:
+            first_stop = self.stopped is None
+            if first_stop:
+                self.stopped = time.time()
+        if first_stop:
+            HISTORY.append(self.history_entry())
+            self._record_history()
+            with SESSION_LOCK:
+                if SESSIONS.get(self.key) is self:
+                    del SESSIONS[self.key]
+        if process.poll() is not None:
+            return False
         try:
-            logging.info("*** Stopping FFmpeg process PID %d", CURRENT_PID)
-            STREAM_PROCESS.terminate()
-            STREAM_PROCESS.wait(timeout=5)
-            logging.info("*** FFmpeg process PID %d stopped", CURRENT_PID)
+            logging.info("*** Stopping FFmpeg process PID %d", process.pid)
+            process.terminate()
+            process.wait(timeout=5)
+            logging.info("*** FFmpeg process PID %d stopped", process.pid)
         except ProcessLookupError:
             logging.info("*** FFmpeg process already stopped")
         except subprocess.TimeoutExpired:
-            logging.warning("*** FFmpeg process PID %d did not stop gracefully, forcing kill", CURRENT_PID)
-            STREAM_PROCESS.kill()
-            STREAM_PROCESS.wait(timeout=2)
+            logging.warning("*** FFmpeg process PID %d did not stop gracefully, forcing kill", process.pid)
+            process.kill()
+            process.wait(timeout=2)
         except Exception as e:
             logging.error("*** Error stopping FFmpeg process: %s", str(e))
-        finally:
-            CURRENT_PID = None
-            STREAM_PROCESS = None
-            return jsonify({"message": "Stream closed successfully"})
-    else:
-        return jsonify({"message": "No stream is running"})
+        return True
+
+def find_rendition(name):
+    """Return the named rendition, or the default one when no name is given."""
+    if not name:
+        return RENDITIONS[0]
+    return next((r for r in RENDITIONS if r['name'] == name), None)
+
+@app.route("/renditions")
+def get_renditions():
+    return jsonify({"renditions": RENDITIONS, "default": RENDITIONS[0]['name']})
+
+def stream_mosaic(key, channels, rendition, layout='grid', audio='all', preset=None, channel_number=CDVR_CHNLNUM):
+    """Join the running session under key or replace it, and stream one rendition."""
+    if ROLE == 'controller':
+        return proxy_mosaic(key, channels, rendition, layout, audio, channel_number)
+    with SESSION_LOCK:
+        session = SESSIONS.get(key)
+        started = False
+        if session and session.is_running() and session.matches(channels, layout, audio):
+            logging.info("*** Joining FFmpeg PID %d with rendition %s", session.pid, rendition['name'])
+        else:
+            replaced = len(session.channels) if session and session.is_running() else 0
+            if len(channels) > free_tuners() + replaced:
+                return "Not enough free tuners", 503
+            # Terminate existing stream
+            if session:
+                session.stop()
+            session = MosaicSession(channels, RENDITIONS, layout, audio, preset, key)
+            session.start()
+            SESSIONS[key] = session
+            started = True
+        q = session.subscribe(rendition['name'])
+
+    def generate():
+        while True:
+            chunk = q.get()
+            if chunk is None:
+                break
+            yield chunk
+
+    # Start monitoring for Channels DVR activity
+    if channel_number and started:
+        threading.Thread(target=watch_for_quit, args=(session, channel_number), daemon=True).start()
+
+    response = Response(stream_with_context(generate()), mimetype='video/MP2T')
+    response.call_on_close(lambda: session.unsubscribe(rendition['name'], q))
+    return response
+
+def live_workers():
+    """Workers whose last heartbeat is recent enough; call with WORKER_LOCK held."""
+    now = time.monotonic()
+    return {wid: w for wid, w in WORKERS.items() if now - w['last_seen'] < WORKER_TIMEOUT_SECONDS}
+
+def pick_worker(rendition_name, exclude=()):
+    """Claim the least-loaded live worker that can encode a rendition; call with WORKER_LOCK held."""
+    candidates = [
+        w for w in live_workers().values()
+        if w['id'] not in exclude and w['load'] < w['capacity'] and rendition_name in w['renditions']
+    ]
+    if not candidates:
+        return None
+    worker = min(candidates, key=lambda w: (w['load'] / w['capacity'], w['backend'] != 'h264_qsv'))
+    worker['load'] += 1
+    return worker
+
+def worker_alive(worker):
+    """Ask a worker directly whether it is still up."""
+    try:
+        return requests.get(f"{worker['url']}/worker/status", timeout=2).ok
+    except Exception:
+        return False
+
+def reschedule(key, placement, rendition_name, failed):
+    """Move a placement off failed workers, unless it was already moved or replaced."""
+    with WORKER_LOCK:
+        if PLACEMENTS.get(key) is not placement:
+            return None
+        if placement['worker'] not in failed and placement['worker'] in live_workers():
+            return WORKERS[placement['worker']]
+        worker = pick_worker(rendition_name, failed)
+        if worker:
+            logging.info("*** Rescheduling session %s on worker %s", key, worker['id'])
+            placement['worker'] = worker['id']
+        return worker
+
+def proxy_mosaic(key, channels, rendition, layout, audio, channel_number):
+    """Place a session on a worker and relay its stream, moving it elsewhere if the worker dies."""
+    stale = None
+    with WORKER_LOCK:
+        placement = PLACEMENTS.get(key)
+        same = bool(placement and placement['clients']) and \
+            (placement['channels'], placement['layout'], placement['audio']) == (channels, layout, audio)
+        if same and placement['worker'] in live_workers():
+            worker = WORKERS[placement['worker']]
+            if rendition['name'] not in worker['renditions']:
+                return f"Worker {worker['id']} running this session has no {rendition['name']} rendition", 503
+            logging.info("*** Joining session %s on worker %s", key, worker['id'])
+        else:
+            replaced = len(placement['channels']) if placement and placement['clients'] else 0
+            if len(channels) > free_tuners() + replaced:
+                return "Not enough free tuners", 503
+            worker = pick_worker(rendition['name'])
+            if not worker:
+                return "No capable worker available", 503
+            if same:
+                placement['worker'] = worker['id']
+            else:
+                if placement and placement['clients']:
+                    stale = placement
+                placement = {'worker': worker['id'], 'channels': channels, 'layout': layout, 'audio': audio, 'clients': 0}
+                PLACEMENTS[key] = placement
+            logging.info("*** Placing session %s on worker %s", key, worker['id'])
+        placement['clients'] += 1
+
+    # The new worker replaces its own session under this key, others must be told
+    if stale and stale['worker'] != worker['id'] and stale['worker'] in WORKERS:
+        try:
+            requests.post(f"{WORKERS[stale['worker']]['url']}/stop", params={'session': key}, timeout=5)
+        except Exception as e:
+            logging.error("*** Error stopping session %s on worker %s: %s", key, stale['worker'], str(e))
+
+    params = {'ch': channels, 'rendition': rendition['name'], 'layout': layout, 'audio': audio,
+              'session': key, 'watch': channel_number or ''}
+
+    def open_upstream(current):
+        return requests.get(f"{current['url']}/combine", params=params, stream=True,
+                            timeout=(5, WORKER_TIMEOUT_SECONDS))
+
+    def drop_worker(current, failed):
+        """Mark a dead worker and move the placement to another one."""
+        with WORKER_LOCK:
+            if current['id'] in WORKERS:
+                WORKERS[current['id']]['last_seen'] = 0
+        failed.add(current['id'])
+        return reschedule(key, placement, rendition['name'], failed)
+
+    def release():
+        with WORKER_LOCK:
+            placement['clients'] -= 1
+            if placement['clients'] <= 0 and PLACEMENTS.get(key) is placement:
+                del PLACEMENTS[key]
+                if placement['worker'] in WORKERS:
+                    WORKERS[placement['worker']]['load'] = max(WORKERS[placement['worker']]['load'] - 1, 0)
+
+    # Open the first upstream before answering so a rejection reaches the client as is
+    current, failed, first = worker, set(), None
+    while current:
+        try:
+            first = open_upstream(current)
+            break
+        except Exception as e:
+            logging.warning("*** Worker %s failed to start session %s: %s", current['id'], key, str(e))
+            if worker_alive(current):
+                break
+            current = drop_worker(current, failed)
+    if first is None or first.status_code != 200:
+        release()
+        if first is None:
+            return "No worker could start the session", 502
+        with first:
+            logging.warning("*** Worker %s rejected session %s: status %d", current['id'], key, first.status_code)
+            return first.text or "Worker rejected the session", first.status_code
+
+    def generate(current, upstream):
+        retries = 0
+        while current:
+            try:
+                r, upstream = upstream or open_upstream(current), None
+                with r:
+                    if r.status_code != 200:
+                        raise IOError(f"status {r.status_code}")
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        retries = 0
+                        yield chunk
+                if worker_alive(current):
+                    # The worker ended the session itself
+                    return
+                raise IOError("worker stopped responding")
+            except Exception as e:
+                logging.warning("*** Worker %s failed for session %s: %s", current['id'], key, str(e))
+                if worker_alive(current):
+                    # Moving a session off a live worker would run it twice, retry there instead
+                    retries += 1
+                    if retries > WORKER_RETRIES:
+                        logging.error("*** Giving up on session %s after %d retries on worker %s", key, WORKER_RETRIES, current['id'])
+                        return
+                    time.sleep(1)
+                    continue
+                current = drop_worker(current, failed)
+
+    def close():
+        # The first upstream is still open if the client left before reading
+        first.close()
+        release()
+
+    response = Response(stream_with_context(generate(current, first)), mimetype='video/MP2T')
+    response.call_on_close(close)
+    return response
+
+def worker_status():
+    """Capabilities and current load this process reports to a controller."""
+    running = [key for key, session in list(SESSIONS.items()) if session.is_running()]
+    return {
+        'id': WORKER_ID,
+        'url': WORKER_URL,
+        'backend': VIDEO_CODEC,
+        'renditions': [r['name'] for r in RENDITIONS],
+        'capacity': WORKER_CAPACITY,
+        'load': len(running),
+        'sessions': running
+    }
+
+def worker_heartbeat():
+    """Register with the controller and keep reporting load."""
+    registered = False
+    logging.info("*** Worker %s reporting to %s", WORKER_ID, CONTROLLER_URL)
+    while True:
+        try:
+            r = requests.post(f"{CONTROLLER_URL}/workers/register", json=worker_status(), timeout=5)
+            if r.ok and not registered:
+                logging.info("*** Registered with controller %s", CONTROLLER_URL)
+            registered = r.ok
+        except Exception as e:
+            if registered:
+                logging.error("*** Lost controller %s: %s", CONTROLLER_URL, str(e))
+            registered = False
+        time.sleep(WORKER_HEARTBEAT_SECONDS)
+
+@app.route("/worker/status")
+def get_worker_status():
+    return jsonify(worker_status())
+
+@app.route("/workers/register", methods=["POST"])
+def register_worker():
+    if ROLE != 'controller':
+        return jsonify({"message": "Not a controller"}), 400
+    data = request.get_json(silent=True) or {}
+    if not data.get('id') or not data.get('url'):
+        return jsonify({"message": "Worker id and url are required"}), 400
+    with WORKER_LOCK:
+        if data['id'] not in live_workers():
+            logging.info("*** Worker %s registered at %s (%s)", data['id'], data['url'], data.get('backend'))
+        WORKERS[data['id']] = {
+            'id': data['id'],
+            'url': data['url'].rstrip('/'),
+            'backend': data.get('backend', 'libx264'),
+            'renditions': data.get('renditions', []),
+            'capacity': max(int(data.get('capacity', 1)), 1),
+            'load': int(data.get('load', 0)),
+            'sessions': data.get('sessions', []),
+            'last_seen': time.monotonic()
+        }
+    return jsonify({"message": "Registered"})
+
+@app.route("/workers")
+def get_workers():
+    with WORKER_LOCK:
+        alive = live_workers()
+        workers = [dict({k: v for k, v in w.items() if k != 'last_seen'}, alive=w['id'] in alive) for w in WORKERS.values()]
+        placements = {key: dict(p) for key, p in PLACEMENTS.items()}
+    return jsonify({"workers": workers, "placements": placements})
+
+@app.route("/combine")
+def combine_streams():
+    channels = request.args.getlist('ch')[:4]
+    if not channels:
+        return "No channels provided", 400
+    rendition = find_rendition(request.args.get('rendition'))
+    if not rendition:
+        return "Unknown rendition", 400
+    layout = request.args.get('layout', 'grid')
+    audio = request.args.get('audio', 'all')
+    if layout not in LAYOUTS or audio not in AUDIO_POLICIES or (audio != 'all' and int(audio) > len(channels)):
+        return "Unknown layout or audio policy", 400
+    key, channel_number = 'combine', CDVR_CHNLNUM
+    if ROLE == 'worker':
+        # The controller names the session and the channel to watch
+        key = request.args.get('session', key)
+        channel_number = request.args.get('watch', channel_number)
+        if not re.fullmatch(r'[\w:.-]{1,64}', key):
+            return "Invalid session", 400
+    return stream_mosaic(key, channels, rendition, layout, audio, channel_number=channel_number)
+
+def validate_preset(data):
+    """Return a clean preset dict from request JSON, or an error message."""
+    if not isinstance(data, dict):
+        return None, "Expected a JSON object"
+    channels = data.get('channels')
+    if not isinstance(channels, list) or not channels:
+        return None, "Expected a list of channels"
+    channels = [str(ch) for ch in channels[:4]]
+    if not all(re.fullmatch(r'\d+(\.\d+)?', ch) for ch in channels):
+        return None, "Invalid channel number"
+    layout = data.get('layout', 'grid')
+    if layout not in LAYOUTS:
+        return None, f"Unknown layout, expected any of: {', '.join(LAYOUTS)}"
+    audio = str(data.get('audio', 'all'))
+    if audio not in AUDIO_POLICIES or (audio != 'all' and int(audio) > len(channels)):
+        return None, "Unknown audio policy, expected 'all' or a tile number"
+    preset_id = str(data.get('id') or uuid.uuid4().hex[:8])
+    if not re.fullmatch(r'[\w-]{1,32}', preset_id):
+        return None, "Invalid preset id"
+    number = str(data.get('number') or PRESETS.get(preset_id, {}).get('number') or next_virtual_channel())
+    if not re.fullmatch(r'\d+(\.\d+)?', number):
+        return None, "Invalid channel number"
+    if any(p['number'] == number and p['id'] != preset_id for p in PRESETS.values()):
+        return None, f"Channel number {number} is already used by another preset"
+    name = str(data.get('name') or ' / '.join(channels)).strip()
+    if len(name) > 100 or re.search(r'[\x00-\x1f\x7f]', name):
+        return None, "Preset name must be at most 100 characters with no control characters"
+    return {'id': preset_id, 'number': number, 'name': name, 'channels': channels, 'layout': layout, 'audio': audio}, None
+
+@app.route("/presets", methods=["GET"])
+def get_presets():
+    return jsonify({"presets": list(PRESETS.values())})
+
+@app.route("/presets", methods=["POST"])
+def save_preset():
+    preset, error = validate_preset(request.get_json(silent=True))
+    if error:
+        return jsonify({"message": error}), 400
+    PRESETS[preset['id']] = preset
+    state_put('presets', preset['id'], preset)
+    compile_mosaic(preset['channels'], preset['layout'], preset['audio'])
+    logging.info("*** Preset %s saved: %s", preset['id'], ', '.join(preset['channels']))
+    return jsonify({"preset": preset})
+
+@app.route("/presets/<preset_id>", methods=["DELETE"])
+def delete_preset(preset_id):
+    preset = PRESETS.pop(preset_id, None)
+    if preset is None:
+        return jsonify({"message": "Unknown preset"}), 404
+    with COMPILED_LOCK:
+        COMPILED_MOSAICS.pop((tuple(preset['channels']), preset['layout'], preset['audio']), None)
+    state_delete('presets', preset_id)
+    return jsonify({"message": "Preset deleted"})
+
+@app.route("/preset/<preset_id>")
+def start_preset(preset_id):
+    preset = PRESETS.get(preset_id)
+    if not preset:
+        return "Unknown preset", 404
+    rendition = find_rendition(request.args.get('rendition'))
+    if not rendition:
+        return "Unknown rendition", 400
+    return stream_mosaic(f"preset:{preset['id']}", preset['channels'], rendition, preset['layout'], preset['audio'],
+                         preset['id'], preset['number'])
+
+@app.route("/presets.m3u")
+def presets_m3u():
+    lines = ['#EXTM3U']
+    for preset in sorted(PRESETS.values(), key=lambda p: float(p['number'])):
+        # Commas end the #EXTINF attributes and line breaks would add entries
+        name = ' '.join(re.sub(r'[\x00-\x1f\x7f,]', ' ', preset['name']).replace('"', "'").split())
+        lines.append(
+            f'#EXTINF:-1 channel-id="m4c-{preset["id"]}" tvg-id="m4c-{preset["id"]}" '
+            f'tvg-chno="{preset["number"]}" tvg-name="{name}" '
+            f'group-title="Multi4Channels",{name}'
+        )
+        lines.append(f'{request.host_url}preset/{preset["id"]}')
+    return Response('\n'.join(lines) + '\n', mimetype='audio/x-mpegurl')
+
+@app.route("/presets.xml")
+def presets_xmltv():
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<tv generator-info-name="Multi4Channels">']
+    for preset in PRESETS.values():
+        lines.append(f'  <channel id="m4c-{preset["id"]}">')
+        lines.append(f'    <display-name>{escape(preset["name"])}</display-name>')
+        lines.append(f'    <display-name>{preset["number"]}</display-name>')
+        lines.append('  </channel>')
+    for preset in PRESETS.values():
+        description = escape(f"Mosaic of channels {', '.join(preset['channels'])}")
+        for block in range(4):
+            block_start = start + timedelta(hours=6 * block)
+            block_stop = block_start + timedelta(hours=6)
+            lines.append(
+                f'  <programme channel="m4c-{preset["id"]}" start="{block_start:%Y%m%d%H%M%S} +0000" '
+                f'stop="{block_stop:%Y%m%d%H%M%S} +0000">'
+            )
+            lines.append(f'    <title>{escape(preset["name"])}</title>')
+            lines.append(f'    <desc>{description}</desc>')
+            lines.append('  </programme>')
+    lines.append('</tv>')
+    return Response('\n'.join(lines) + '\n', mimetype='application/xml')
+
+@app.route("/history")
+def get_history():
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({"history": list(HISTORY)[::-1][:limit]})
+
+@app.route("/stop", methods=["POST"])
+def stop_stream():
+    key = request.args.get('session')
+    with SESSION_LOCK:
+        sessions = [s for k, s in SESSIONS.items() if key in (None, k)]
+    stopped = [session for session in sessions if session.stop()]
+    if ROLE == 'controller':
+        with WORKER_LOCK:
+            workers = list(live_workers().values())
+        for worker in workers:
+            try:
+                r = requests.post(f"{worker['url']}/stop", params={'session': key} if key else None, timeout=5)
+                if r.ok and r.json().get("message") == "Stream closed successfully":
+                    stopped.append(worker['id'])
+            except Exception as e:
+                logging.error("*** Error stopping streams on worker %s: %s", worker['id'], str(e))
+    if stopped:
+        return jsonify({"message": "Stream closed successfully"})
+    return jsonify({"message": "No stream is running"})
 
 @app.route("/reload_m3u")
 def reload_m3u():
@@ -730,57 +1684,236 @@ def reload_m3u():
 
 @app.route("/channels")
 def get_channels():
-    return jsonify({"channels": CHANNELS, "favorites": FAVORITES})
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', CHANNEL_PAGE_SIZE)), 0), CHANNEL_PAGE_MAX)
+    except ValueError:
+        return "Invalid offset or limit", 400
+    fields = [f for f in request.args.get('fields', ','.join(CHANNEL_FIELDS)).split(',') if f]
+    if any(f not in CHANNEL_FIELDS for f in fields):
+        return f"Unknown field, expected any of: {', '.join(CHANNEL_FIELDS)}", 400
+
+    etag = f"{M3U_VERSION}-{FAVORITES_VERSION}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    matches = search_channels(request.args.get('q', ''))
+    page = []
+    for channel in matches[offset:offset + limit]:
+        row = dict(channel, favorite=channel['number'] in FAVORITES)
+        page.append({f: row[f] for f in fields})
+    next_offset = offset + limit if offset + limit < len(matches) else None
+
+    data = {"channels": page, "total": len(matches), "offset": offset, "next_offset": next_offset, "version": M3U_VERSION}
+    if request.args.get('favorites') != '0':
+        data["favorites"] = list(FAVORITES.values())
+    response = jsonify(data)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route("/toggle_favorite", methods=["POST"])
 def toggle_favorite():
-    global FAVORITES
+    global FAVORITES_VERSION
     data = request.get_json()
     channel = {"number": data["number"], "name": data["name"]}
-    if channel in FAVORITES:
-        FAVORITES.remove(channel)
+    if FAVORITES.pop(channel['number'], None) is None:
+        FAVORITES[channel['number']] = channel
+    FAVORITES_VERSION = favorites_version()
+    if channel['number'] in FAVORITES:
+        state_put('favorites', channel['number'], channel)
     else:
-        FAVORITES.append(channel)
-    save_favorites()
-    return jsonify({"favorites": FAVORITES})
+        state_delete('favorites', channel['number'])
+    return jsonify({"favorites": list(FAVORITES.values())})
 
 @app.route("/save_favorites")
 def save_favorites_endpoint():
-    save_favorites()
+    flush_state()
     return jsonify({"message": "Favorites saved successfully"})
 
-def watch_for_quit():
-    global CURRENT_PID, STREAM_PROCESS
-    inactive_minutes = 0
-    logging.info("*** Monitoring activity on channel %s", CDVR_CHNLNUM)
+def grab_thumbnail(number):
+    """Decode one keyframe of a channel and return it as a small JPEG."""
+    url = f"http://{CDVR_HOST}:{CDVR_PORT}/devices/ANY/channels/{number}/stream.mpg"
+    ffmpeg_cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-skip_frame', 'nokey', '-i', url,
+        '-an', '-sn', '-frames:v', '1',
+        '-vf', f'scale={THUMBNAIL_WIDTH}:-2',
+        '-q:v', '5', '-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1'
+    ]
+    try:
+        result = subprocess.run(ffmpeg_cmd, capture_output=True, timeout=THUMBNAIL_TIMEOUT_SECONDS)
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+        logging.error("*** Thumbnail grab failed for channel %s: %s", number, result.stderr.decode(errors='replace').strip())
+    except subprocess.TimeoutExpired:
+        logging.error("*** Thumbnail grab timed out for channel %s", number)
+    except Exception as e:
+        logging.error("*** Error grabbing thumbnail for channel %s: %s", number, str(e))
+    return None
+
+def cache_thumbnail(number, data):
+    """Store a thumbnail, evicting the least recently used ones past the size cap."""
+    global THUMBNAIL_BYTES, THUMBNAIL_SWEEP_DONE
+    with THUMBNAIL_LOCK:
+        old = THUMBNAILS.pop(number, None)
+        if old:
+            THUMBNAIL_BYTES -= len(old['data'])
+        THUMBNAILS[number] = {
+            'data': data,
+            'etag': hashlib.sha1(data).hexdigest(),
+            'updated': time.monotonic()
+        }
+        THUMBNAIL_BYTES += len(data)
+        while THUMBNAIL_BYTES > THUMBNAIL_CACHE_BYTES and len(THUMBNAILS) > 1:
+            _, evicted = THUMBNAILS.popitem(last=False)
+            THUMBNAIL_BYTES -= len(evicted['data'])
+            # The cache is full, stop sweeping the rest of the lineup
+            THUMBNAIL_SWEEP_DONE = True
+
+def get_thumbnail(number):
+    """Return a cached thumbnail and mark it recently used, or None."""
+    with THUMBNAIL_LOCK:
+        entry = THUMBNAILS.get(number)
+        if entry:
+            THUMBNAILS.move_to_end(number)
+        return entry
+
+def free_tuners():
+    """Number of tuners not held by running mosaics or thumbnail grabs."""
+    in_use = sum(len(session.channels) for session in list(SESSIONS.values()) if session.is_running())
+    in_use += sum(len(placement['channels']) for placement in list(PLACEMENTS.values()) if placement['clients'])
+    in_use += THUMBNAIL_GRABS
+    return TUNER_COUNT - in_use
 
+def next_thumbnail_channel():
+    """Pick the channel whose thumbnail is most worth refreshing next.
+
+    Favorites come first, then channels a client asked for, then the rest of
+    the lineup until the cache first fills up.
+    """
+    now = time.monotonic()
+    with THUMBNAIL_LOCK:
+        def stale(number):
+            failed = THUMBNAIL_FAILED.get(number)
+            if failed and now < failed['retry_at']:
+                return False
+            entry = THUMBNAILS.get(number)
+            return entry is None or now - entry['updated'] >= THUMBNAIL_MAX_AGE_SECONDS
+
+        for number in FAVORITES:
+            if stale(number):
+                return number
+        while THUMBNAIL_REQUESTS:
+            number, _ = THUMBNAIL_REQUESTS.popitem(last=False)
+            if stale(number):
+                return number
+        if not THUMBNAIL_SWEEP_DONE:
+            for channel in CHANNELS:
+                if channel['number'] not in THUMBNAILS and stale(channel['number']):
+                    return channel['number']
+    return None
+
+def record_thumbnail_result(number, ok):
+    """Clear a channel's failure record, or back off its next grab exponentially."""
+    with THUMBNAIL_LOCK:
+        if ok:
+            THUMBNAIL_FAILED.pop(number, None)
+            return
+        failures = THUMBNAIL_FAILED.get(number, {}).get('failures', 0) + 1
+        delay = min(THUMBNAIL_RETRY_SECONDS * 2 ** (failures - 1), THUMBNAIL_MAX_AGE_SECONDS)
+        THUMBNAIL_FAILED[number] = {'failures': failures, 'retry_at': time.monotonic() + delay}
+
+def refresh_thumbnails():
+    """Background loop grabbing one thumbnail per interval while a tuner is free."""
+    global THUMBNAIL_GRABS
+    logging.info("*** Thumbnail refresh every %d s, cache cap %d bytes", THUMBNAIL_INTERVAL_SECONDS, THUMBNAIL_CACHE_BYTES)
     while True:
+        try:
+            if free_tuners() > 0:
+                number = next_thumbnail_channel()
+                if number:
+                    # Hold a tuner for the grab so mosaics don't start on top of it
+                    with THUMBNAIL_LOCK:
+                        THUMBNAIL_GRABS += 1
+                    try:
+                        data = grab_thumbnail(number)
+                    finally:
+                        with THUMBNAIL_LOCK:
+                            THUMBNAIL_GRABS -= 1
+                    if data:
+                        cache_thumbnail(number, data)
+                    record_thumbnail_result(number, bool(data))
+        except Exception as e:
+            logging.error("*** Error refreshing thumbnails: %s", str(e))
+        time.sleep(THUMBNAIL_INTERVAL_SECONDS)
+
+@app.route("/thumbnail/<number>")
+def thumbnail(number):
+    entry = get_thumbnail(number)
+    if (not entry or time.monotonic() - entry['updated'] >= THUMBNAIL_MAX_AGE_SECONDS) and number in CHANNEL_INDEX:
+        # Queue missing or expired thumbnails, an expired one is still served meanwhile
+        with THUMBNAIL_LOCK:
+            THUMBNAIL_REQUESTS[number] = True
+    if not entry:
+        return "Thumbnail not available yet", 404
+    response = Response(entry['data'], mimetype='image/jpeg')
+    response.set_etag(entry['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE_SECONDS
+    return response.make_conditional(request)
+
+if THUMBNAIL_INTERVAL_SECONDS > 0 and ROLE != 'worker':
+    threading.Thread(target=refresh_thumbnails, daemon=True).start()
+
+@app.after_request
+def gzip_response(response):
+    """Compress JSON responses for clients that accept gzip."""
+    if (response.mimetype != 'application/json' or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def watch_for_quit(session, channel_number):
+    inactive_minutes = 0
+    watched = re.compile(rf'(?<![\w.])ch{re.escape(channel_number)}(?![\w.])', re.IGNORECASE)
+    logging.info("*** Monitoring activity on channel %s", channel_number)
+
+    while session.is_running():
         try:
             r = requests.get(f"http://{CDVR_HOST}:{CDVR_PORT}/dvr", timeout=5)
             if r.status_code == 200:
-                if f"ch{CDVR_CHNLNUM}".lower() in r.text.lower():
-                    logging.info("*** Channel %s still being watched", CDVR_CHNLNUM)
+                if watched.search(r.text):
+                    logging.info("*** Channel %s still being watched", channel_number)
                     inactive_minutes = 0
                 else:
                     inactive_minutes += 1
-                    logging.info("*** Channel no longer being watched. Countdown to kill: %d / %d min", inactive_minutes, KILL_COUNTDOWN_MINUTES)
+                    logging.info("*** Channel %s no longer being watched. Countdown to kill: %d / %d min", channel_number, inactive_minutes, KILL_COUNTDOWN_MINUTES)
                     if inactive_minutes >= KILL_COUNTDOWN_MINUTES:
-                        if CURRENT_PID and STREAM_PROCESS:
-                            try:
-                                logging.info("*** Killing FFmpeg process PID %d", CURRENT_PID)
-                                STREAM_PROCESS.terminate()
-                                STREAM_PROCESS.wait(timeout=5)
-                                logging.info("*** FFmpeg process PID %d killed", CURRENT_PID)
-                            except Exception as e:
-                                logging.error("*** Error killing FFmpeg: %s", str(e))
-                            CURRENT_PID = None
-                            STREAM_PROCESS = None
+                        logging.info("*** Killing FFmpeg process PID %d", session.pid)
+                        session.stop()
                         return
         except Exception as e:
             logging.error("*** Error checking DVR activity: %s", str(e))
 
         time.sleep(CHECK_INTERVAL_SECONDS)
 
+if ROLE == 'worker':
+    if CONTROLLER_URL:
+        threading.Thread(target=worker_heartbeat, daemon=True).start()
+    else:
+        logging.error("*** ROLE=worker needs CONTROLLER_URL to register")
+
 if __name__ == "__main__":
-    logging.info("*** Starting Flask app")
+    logging.info("*** Starting Flask app as %s", ROLE)
     app.run(host="0.0.0.0", port=WEB_PAGE_PORT)
@@ -0,0 +1,31 @@
+#!/bin/bash
+# Run a controller and several encode workers on this host for testing.
+# Usage: ./cluster-local.sh [workers]   (default 2, Ctrl-C stops everything)
+# The controller listens on WEB_PAGE_PORT (default 9799), worker n on WEB_PAGE_PORT+n.
+# Each process gets its own WORKER_ID, port and STATE_DB under DATA_DIR.
+# CDVR_HOST/CDVR_PORT and the other settings are taken from the environment.
+WORKERS=${1:-2}
+BASE_PORT=${WEB_PAGE_PORT:-9799}
+DATA_DIR=${DATA_DIR:-/tmp/multi4channels-cluster}
+mkdir -p "$DATA_DIR"
+cd "$(dirname "$0")/app" || exit 1
+
+pids=()
+trap 'kill "${pids[@]}" 2>/dev/null' EXIT
+
+echo "*** Starting controller on port $BASE_PORT"
+ROLE=controller WEB_PAGE_PORT=$BASE_PORT STATE_DB=$DATA_DIR/controller.db \
+    python3 app.py > "$DATA_DIR/controller.log" 2>&1 &
+pids+=($!)
+
+for n in $(seq 1 "$WORKERS"); do
+    port=$((BASE_PORT + n))
+    echo "*** Starting worker$n on port $port"
+    ROLE=worker WEB_PAGE_PORT=$port WORKER_ID=worker$n WORKER_URL=http://127.0.0.1:$port \
+        CONTROLLER_URL=http://127.0.0.1:$BASE_PORT STATE_DB=$DATA_DIR/worker$n.db \
+        python3 app.py > "$DATA_DIR/worker$n.log" 2>&1 &
+    pids+=($!)
+done
+
+echo "*** Logs in $DATA_DIR, worker registry at http://127.0.0.1:$BASE_PORT/workers"
+wait
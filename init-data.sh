@@ -6,6 +6,12 @@ if [ ! -f /app/data/favorites.json ]; then
 fi
 echo "*** Updating permissions for /app/data/favorites.json"
 chmod 666 /app/data/favorites.json
+echo "*** Updating permissions for /app/data/state.db"
+for f in /app/data/state.db /app/data/state.db-wal /app/data/state.db-shm; do
+    if [ -f "$f" ]; then
+        chmod 666 "$f"
+    fi
+done
 echo "*** /app/data permissions"
 ls -l /app/data
 echo "*** Checking /app/data permissions"